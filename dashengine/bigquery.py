@@ -2,23 +2,33 @@ import os
 import uuid
 import json
 import datetime
+import functools
+import threading
 import google.auth
+from google.api_core.exceptions import Forbidden
 import pandas as pd
 from ruamel.yaml import YAML
+from ruamel.yaml.error import YAMLError
 from dataclasses import dataclass
+from concurrent.futures import Future
 from google.cloud import bigquery
-from dashengine.dashapp import cache
+from google.cloud import bigquery_storage
+from dashengine.dashapp import cache, QUERY_CACHE_TIMEOUT, QUERY_CACHE_MAXSIZE
 
 # BigQuery
 DIALECT = "standard"
 QUERY_DATA_DIRECTORY = "queries"
 CREDENTIALS, PROJECT_ID = google.auth.default()
 
-# YAML parser
-yaml = YAML(typ="safe")
+# YAML parser (libyaml-backed via ruamel.yaml.clib)
+yaml = YAML(typ="safe", pure=False)
 
+# Queries currently executing in this process, keyed by registry key
+_INFLIGHT = {}
+_INFLIGHT_LOCK = threading.Lock()
 
-@dataclass(frozen=True)
+
+@dataclass(frozen=True, slots=True)
 class BigQuery:
     """A BigQuery query message.
 
@@ -40,7 +50,7 @@ class BigQuery:
     parameter_spec: dict
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class BigQueryResult:
     """Results of a BigQuery request.
 
@@ -56,6 +66,7 @@ class BigQueryResult:
         duration (datetime.time): The time taken to execute the query.
         bytes_billed (float): The amount of billable bytes processed in BQ.
         bytes_processed (float): The total number of bytes processed in BQ.
+        memory (float): The memory usage of the result in MB.
     """
 
     uuid: str
@@ -66,26 +77,24 @@ class BigQueryResult:
     duration: datetime.time
     bytes_billed: float
     bytes_processed: float
+    memory: float
 
     def memory_usage(self) -> float:
         """Returns the memory usage of the stored dataframe in MB."""
-        return self.result.memory_usage(index=True, deep=True).sum() / 1.0e6
+        return self.memory
 
 
-def _load_query(query_id: str) -> BigQuery:
-    """Loads a query from file by query id.
-    This function reads a query from file, according to the provided id, and
-    returns it as a BigQuery object.
+def _parse_query_file(query_id: str, path: str) -> BigQuery:
+    """Parses a query file into a BigQuery object.
 
     Args:
         query_id (str): A string identifier for the query.
+        path (str): The path of the query file.
 
     Returns:
         (BigQuery): The query and query metadata.
     """
-    target_queryfile = os.path.join(QUERY_DATA_DIRECTORY, query_id + ".yml")
-
-    with open(target_queryfile, "r") as infile:
+    with open(path, "r") as infile:
         try:
             qdata = yaml.load(infile)
             # Build query object
@@ -99,18 +108,69 @@ def _load_query(query_id: str) -> BigQuery:
             return query_object
 
         # TODO figure out better error handling scheme
-        except yaml.YAMLError as exc:
+        except YAMLError as exc:
             import logging
 
             logging.error(exc)
             raise exc
 
 
+def _preload_queries(directory: str) -> dict:
+    """Parses all query files in a directory, including its subdirectories.
+
+    Args:
+        directory (str): The directory containing the query files.
+
+    Returns:
+        (dict): The parsed BigQuery objects keyed by query id, i.e. the path
+            of the query file relative to `directory` without extension.
+    """
+    if not os.path.isdir(directory):
+        return {}
+    queries = {}
+    for root, _, filenames in os.walk(directory, followlinks=True):
+        for filename in filenames:
+            name, extension = os.path.splitext(filename)
+            if extension != ".yml":
+                continue
+            query_id = os.path.relpath(os.path.join(root, name), directory)
+            query_id = query_id.replace(os.sep, "/")
+            queries[query_id] = _parse_query_file(
+                query_id, os.path.join(root, filename)
+            )
+    return queries
+
+
+# Query definitions are static, so they are all parsed once at startup
+_QUERY_DEFINITIONS = _preload_queries(QUERY_DATA_DIRECTORY)
+
+
+def _load_query(query_id: str) -> BigQuery:
+    """Loads a query by query id.
+    This function returns the query, parsed at startup from the file
+    matching the provided id, as a BigQuery object.
+
+    Args:
+        query_id (str): A string identifier for the query.
+
+    Returns:
+        (BigQuery): The query and query metadata.
+
+    Raises:
+        FileNotFoundError: If there is no query file for the id.
+    """
+    try:
+        return _QUERY_DEFINITIONS[query_id]
+    except KeyError:
+        target_queryfile = os.path.join(QUERY_DATA_DIRECTORY, query_id + ".yml")
+        raise FileNotFoundError(f"Query file '{target_queryfile}' not found") from None
+
+
 def fetch_num_cached_queries() -> int:
-    """Lists all cached queries.
+    """Counts the cached queries without fetching their results.
 
     Returns:
-        (list): A list of all cached queries in the form of BigQueryResult objects.
+        (int): The number of queries in the query registry.
     """
     # Fetch registry of queries
     registry = cache.get("query-registry")
@@ -136,6 +196,28 @@ def fetch_cached_queries() -> list:
     return cached_queries
 
 
+@functools.lru_cache(maxsize=None)
+def _get_client() -> bigquery.Client:
+    """Returns the shared BigQuery client.
+
+    The client is built lazily on first use, so that importing this module
+    does not set up any connections, and is then reused for all queries.
+    """
+    return bigquery.Client(credentials=CREDENTIALS, project=PROJECT_ID)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_storage_client() -> bigquery_storage.BigQueryReadClient:
+    """Returns the shared BigQuery Storage read client.
+
+    Query results are downloaded through the Storage Read API as Arrow
+    record batches, which is considerably faster than paging through the
+    JSON REST endpoint for all but the smallest results. Where the Storage
+    Read API is not permitted, results fall back to the REST endpoint.
+    """
+    return bigquery_storage.BigQueryReadClient(credentials=CREDENTIALS)
+
+
 def _build_query_parameters(query: BigQuery, parameters: dict) -> list:
     """Builds the parameter list for a BigQuery job from a supplied
     list of parameter values.
@@ -167,22 +249,100 @@ def _build_query_parameters(query: BigQuery, parameters: dict) -> list:
     return query_params
 
 
-def _register_query(query_id: str, parameters: dict):
+def _compact_strings(df: pd.DataFrame) -> pd.DataFrame:
+    """Stores the string columns of a query result as Arrow-backed strings.
+
+    Arrow-backed strings take roughly half the memory of object-dtype
+    strings. All other columns keep the dtypes returned by BigQuery. If
+    pyarrow is not available the result is returned unchanged.
+
+    Args:
+        df (pandas.DataFrame): The query result to be compacted.
+
+    Returns:
+        (pandas.DataFrame): The compacted query result.
+    """
+    for column in df.columns:
+        series = df[column]
+        if not pd.api.types.is_object_dtype(series):
+            continue
+        if pd.api.types.infer_dtype(series, skipna=True) == "string":
+            try:
+                df[column] = series.astype("string[pyarrow]")
+            except ImportError:
+                return df
+    return df
+
+
+def _registry_key(query_id: str, parameters: dict) -> str:
+    """Returns the key identifying a query and its parameters."""
+    return query_id + ":" + json.dumps(parameters, sort_keys=True, default=str)
+
+
+def _result_key(query_id: str, parameters: dict) -> str:
+    """Returns the cache key of the result of a query and its parameters."""
+    return "query-result:" + _registry_key(query_id, parameters)
+
+
+def _register_query(query_id: str, parameters: dict, result_uuid: str):
     """Add a query and it's parameters to the query registry.
 
+    The UUID of the result is also recorded in a UUID index, so that
+    cached results can be looked up directly by UUID. The registry is kept
+    in order of execution and bounded to `QUERY_CACHE_MAXSIZE` entries, the
+    least recently run queries being dropped first.
+
     Note that this is not thread-safe: The registry is meant
     for debug purposes and therefore should normally only be
     run in a single-threaded debug server.
     """
-    registry_key = query_id + ":" + json.dumps(parameters, sort_keys=True, default=str)
+    registry_key = _registry_key(query_id, parameters)
     registry = cache.get("query-registry")
     if registry is None:
         registry = {}
-    registry[registry_key] = {"query_id": query_id, "parameters": parameters}
-    cache.set("query-registry", registry)
+    uuid_index = cache.get("query-uuid-index")
+    if uuid_index is None:
+        uuid_index = {}
+    # Drop any previous result for the same query
+    previous = registry.pop(registry_key, None)
+    if previous is not None:
+        uuid_index.pop(previous.get("uuid"), None)
+    entry = {"query_id": query_id, "parameters": parameters, "uuid": result_uuid}
+    registry[registry_key] = entry
+    uuid_index[result_uuid] = entry
+    # Evict the least recently run queries
+    while len(registry) > QUERY_CACHE_MAXSIZE:
+        evicted = registry.pop(next(iter(registry)))
+        uuid_index.pop(evicted.get("uuid"), None)
+    cache.set("query-registry", registry, timeout=QUERY_CACHE_TIMEOUT)
+    cache.set("query-uuid-index", uuid_index, timeout=QUERY_CACHE_TIMEOUT)
+
+
+def get_cached_by_uuid(result_uuid: str) -> BigQueryResult:
+    """Fetches a cached query result by its UUID.
+
+    The cached result is read directly from the cache, so this never runs
+    a query in BigQuery.
+
+    Args:
+        result_uuid (str): The UUID of the query result.
+
+    Returns:
+        (BigQueryResult): The corresponding query result.
+
+    Raises:
+        KeyError: If no cached result has the requested UUID.
+    """
+    uuid_index = cache.get("query-uuid-index")
+    if uuid_index is None:
+        raise KeyError(result_uuid)
+    entry = uuid_index[result_uuid]
+    result = cache.get(_result_key(entry["query_id"], entry["parameters"]))
+    if result is None or result.uuid != result_uuid:
+        raise KeyError(result_uuid)
+    return result
 
 
-@cache.memoize(timeout=300)
 def run_query(query_id: str, parameters: dict = {}) -> BigQueryResult:
     """Performs a query over BigQuery and returns the result.
 
@@ -199,8 +359,52 @@ def run_query(query_id: str, parameters: dict = {}) -> BigQueryResult:
     Returns:
         (BigQueryResult): The results of the query.
     """
-    # Setup BigQuery client
-    client = bigquery.Client()
+    result_key = _result_key(query_id, parameters)
+    result = cache.get(result_key)
+    if result is not None:
+        return result
+
+    # Coalesce concurrent requests for the same uncached query, so that
+    # only the first request runs it and the others wait for its result
+    with _INFLIGHT_LOCK:
+        future = _INFLIGHT.get(result_key)
+        is_leader = future is None
+        if is_leader:
+            future = _INFLIGHT[result_key] = Future()
+    if not is_leader:
+        return future.result()
+
+    try:
+        # A previous leader may have cached the result since the check above
+        result = cache.get(result_key)
+        if result is None:
+            result = _execute_query(query_id, parameters)
+            # Cache before resolving, so no caller sees neither the cached
+            # result nor the in-flight query
+            cache.set(result_key, result, timeout=QUERY_CACHE_TIMEOUT)
+        future.set_result(result)
+        return result
+    except BaseException as exc:
+        # Also resolve on e.g. SystemExit, so that waiters never hang
+        future.set_exception(exc)
+        raise
+    finally:
+        with _INFLIGHT_LOCK:
+            del _INFLIGHT[result_key]
+
+
+def _execute_query(query_id: str, parameters: dict) -> BigQueryResult:
+    """Executes a query in BigQuery and registers the result.
+
+    Args:
+        query_id (str): A string identifier for the query.
+        parameters (dict): A dictionary of query parameters.
+
+    Returns:
+        (BigQueryResult): The results of the query.
+    """
+    # Fetch the shared BigQuery client
+    client = _get_client()
     # Read query
     query = _load_query(query_id)
 
@@ -210,13 +414,18 @@ def run_query(query_id: str, parameters: dict = {}) -> BigQueryResult:
 
     # Run query
     query_result = client.query(query.body, job_config=job_config)
-    query_data = query_result.to_dataframe()
+    try:
+        query_data = query_result.to_dataframe(bqstorage_client=_get_storage_client())
+    except Forbidden as exc:
+        # No read session permission, or the Storage Read API is disabled
+        import logging
 
-    # Register the query in the cache (for the profiler)
-    _register_query(query_id, parameters)
+        logging.warning(f"BigQuery Storage API unavailable, using REST: {exc}")
+        query_data = query_result.to_dataframe(create_bqstorage_client=False)
+    query_data = _compact_strings(query_data)
 
     # Form up results class
-    return BigQueryResult(
+    result = BigQueryResult(
         str(uuid.uuid4()),
         query,
         parameters,
@@ -225,4 +434,9 @@ def run_query(query_id: str, parameters: dict = {}) -> BigQueryResult:
         (query_result.ended - query_result.started).microseconds / 1.0e6,
         query_result.total_bytes_billed,
         query_result.total_bytes_processed,
+        query_data.memory_usage(index=True, deep=True).sum() / 1.0e6,
     )
+
+    # Register the query in the cache (for the profiler)
+    _register_query(query_id, parameters, result.uuid)
+    return result
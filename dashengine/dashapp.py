@@ -31,5 +31,10 @@ dashapp.title = CONFIGURATION["APP_NAME"]
 # Setup server secret key for CSRF protection
 dashapp.server.secret_key = os.environ.get("SECRET_KEY", "default-secret-key")
 
+# Query cache expiry (seconds) and maximum number of cached items
+QUERY_CACHE_TIMEOUT = int(os.environ.get("BQ_CACHE_TTL", 300))
+QUERY_CACHE_MAXSIZE = int(os.environ.get("BQ_CACHE_MAXSIZE", 1024))
+
 # Setup cache according to configuration
+CONFIGURATION["cache-config"].setdefault("CACHE_THRESHOLD", QUERY_CACHE_MAXSIZE)
 cache = Cache(dashapp.server, config=CONFIGURATION["cache-config"])
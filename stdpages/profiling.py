@@ -1,6 +1,9 @@
 """ Page for the monitoring of query performance characteristics. """
 import json
 
+# Pandas
+import pandas as pd
+
 # Plotly
 import plotly.graph_objs as go
 
@@ -16,6 +19,8 @@ import dashengine.bigquery as bigquery
 ROUTE = "/profile"
 # Name used when linking, for example in the navigation bar
 LINKNAME = "Profiling"
+# Per-query metrics shown in the summary chart
+METRICS = ["Memory", "Duration", "Bytes Processed", "Bytes Billed"]
 
 
 # Helper functions #################################################
@@ -30,55 +35,36 @@ def __fetch_query_from_uuid(uuid: str) -> bigquery.BigQueryResult:
     Returns:
         (BigQueryResult): The corresponding BigQuery result object.
     """
-    # Fetch cached queries
-    queries = bigquery.fetch_cached_queries()
-    selected_query = None
-    for query in queries:
-        if query.uuid == uuid:
-            # Select a query UUID
-            selected_query = query
-    if selected_query is None:
+    try:
+        return bigquery.get_cached_by_uuid(uuid)
+    except KeyError:
         raise RuntimeError(f"Cannot find query with UUID {uuid}")
-    return selected_query
 
 
-def __index_query(query, key: str) -> float:
-    """Returns a property of the query class, keyed by a string.
-    The key must be one of:
-        ['Memory', 'Duration', 'Bytes Processed', 'Bytes Billed']
+def __query_metrics(cached_queries: list) -> pd.DataFrame:
+    """Builds a table of the profiling metrics of each query.
 
     Args:
-        query (BigQueryResult): A BigQuery result class
-        key (string): A key of the BigQueryResult object
+        cached_queries (list): A list of BigQueryResult objects.
 
     Returns:
-        (float): The value in `query` corresponding to the key.
+        (pandas.DataFrame): The metrics in `METRICS`, indexed by query UUID.
     """
-    ResultDict = {
-        "Memory": query.memory_usage(),
-        "Duration": query.duration,
-        "Bytes Processed": query.bytes_processed,
-        "Bytes Billed": query.bytes_billed,
-    }
-    return ResultDict[key]
+    return pd.DataFrame(
+        [
+            (query.memory, query.duration, query.bytes_processed, query.bytes_billed)
+            for query in cached_queries
+        ],
+        index=[query.uuid for query in cached_queries],
+        columns=METRICS,
+        dtype=float,
+    )
 
 
-def __normalising_constants(cached_queries: list):
+def __normalising_constants(metrics: pd.DataFrame) -> dict:
     """Computes totals over the full set of cached queries to normalise the summary chart."""
-    totals = {
-        "Memory": 0.0,
-        "Duration": 0.0,
-        "Bytes Processed": 0.0,
-        "Bytes Billed": 0.0,
-    }
-    for query in cached_queries:
-        for key in totals:
-            totals[key] += __index_query(query, key)
     # Avoid dividing by zero
-    for key in totals:
-        if totals[key] == 0:
-            totals[key] = 1
-    return totals
+    return metrics.sum().replace(0, 1).to_dict()
 
 
 # Dash callbacks #################################################
@@ -91,19 +77,14 @@ def __normalising_constants(cached_queries: list):
 def _query_profile_summary_chart(_) -> go.Figure:
     """Generates a set of bar charts for a single query."""
     cached_queries = bigquery.fetch_cached_queries()
-    yvals = ["Memory", "Duration", "Bytes Processed", "Bytes Billed"]
-    totals = __normalising_constants(cached_queries)
-
-    def __bar(query):
-        """Generate a single bar."""
-        return go.Bar(
-            y=yvals,
-            x=[100 * __index_query(query, key) / totals[key] for key in yvals],
-            name=query.uuid,
-            orientation="h",
-        )
+    metrics = __query_metrics(cached_queries)
+    totals = __normalising_constants(metrics)
+    percentages = metrics.div(pd.Series(totals)).mul(100)
 
-    bar_charts = [__bar(query) for query in cached_queries]
+    bar_charts = [
+        go.Bar(y=METRICS, x=row, name=uuid, orientation="h")
+        for uuid, row in zip(percentages.index, percentages.to_numpy().tolist())
+    ]
     layout = go.Layout(barmode="stack")
     return go.Figure(data=bar_charts, layout=layout)
 
@@ -116,21 +97,26 @@ def _query_profile_table(_) -> dash_table.DataTable:
     """Generates a table profiling all cached queries."""
     cached_queries = bigquery.fetch_cached_queries()
     # Setup all data for the table
-    data = [
-        {
-            "ID": query.source.query_id,
-            "UUID": query.uuid,
-            "Parameters": json.dumps(query.parameters, default=str),
-            "Duration": query.duration,
-            "Memory Usage": query.memory_usage(),
-            "Bytes Processed": query.bytes_processed,
-            "Bytes Billed": query.bytes_billed,
-        }
-        for query in cached_queries
+    metrics = __query_metrics(cached_queries)
+    table = metrics.rename(columns={"Memory": "Memory Usage"}).assign(
+        ID=[query.source.query_id for query in cached_queries],
+        UUID=metrics.index,
+        Parameters=[
+            json.dumps(query.parameters, default=str) for query in cached_queries
+        ],
+    )
+    table_columns = [
+        "ID",
+        "UUID",
+        "Parameters",
+        "Duration",
+        "Memory Usage",
+        "Bytes Processed",
+        "Bytes Billed",
     ]
+    data = table[table_columns].to_dict("records")
     hidden_columns = ["Parameters"]
-    # Build list of columns from the data keys
-    columns = [{"name": i, "id": i} for i in data[0]]
+    columns = [{"name": i, "id": i} for i in table_columns]
     # Build datatable
     return dash_table.DataTable(
         id="query-profile-table",
@@ -207,9 +193,17 @@ def _query_profile_details(rows, selected_row_indices) -> list:
             )
         ]
     # Determine selected UUID
-    selected_queryID = rows[selected_row_indices[0]]["ID"]
-    selected_params = json.loads(rows[selected_row_indices[0]]["Parameters"])
-    selected_query = bigquery.run_query(selected_queryID, selected_params)
+    selected_UUID = rows[selected_row_indices[0]]["UUID"]
+    try:
+        selected_query = __fetch_query_from_uuid(selected_UUID)
+    except RuntimeError:
+        # Result expired (or is cached by another instance), don't re-run it
+        return [
+            html.H5(
+                "Query result is no longer cached, refresh to update the profiler",
+                style={"textAlign": "center", "margin-top": "30px"},
+            )
+        ]
     return [
         html.H3("Query Details", style={"textAlign": "center", "margin-top": "30px"}),
         html.H4("Query Body", style={"textAlign": "left"}),